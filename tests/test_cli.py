@@ -1,3 +1,5 @@
+import http.client
+import io
 import json
 import logging
 import sys
@@ -5,7 +7,13 @@ from unittest.mock import Mock
 
 import pytest
 
-from cli.main import get_opts, process_data
+from cli.main import _get_download_ids, get_opts, process_data
+
+
+class FakeResponse(io.BytesIO):
+    """A binary response body with the status attribute _request checks."""
+
+    status = 200
 
 
 class TestGetOpts:
@@ -36,31 +44,30 @@ class TestGetOpts:
 
 
 class TestProcessData:
+    @pytest.fixture(autouse=True)
+    def clear_metadata_cache(self):
+        # The download-ID fetch is memoized; clear it so each test's mocked
+        # responses are consumed in order.
+        _get_download_ids.cache_clear()
+
     def test_process_data_basic(self, capsys, mocker):
         # Mock the export API response
         mock_export_response = Mock()
+        mock_export_response.status = 200
         mock_export_response.read.return_value = (
             b'{"data": {"download_ids": ["test-id"]}}'
         )
-        mock_export_response.__enter__ = Mock(return_value=mock_export_response)
-        mock_export_response.__exit__ = Mock(return_value=None)
 
-        # Mock the data API response
-        mock_data_response = Mock()
-        mock_data_response.readline.return_value = (
+        # Mock the data API response (a binary stream, header included)
+        mock_data_response = FakeResponse(
             b"patient_id,event_time,event_type,value\n"
+            b"P001,2023-01-01T00:00:00Z,heart_rate,75\n"
         )
-        mock_data_response.__iter__ = Mock(
-            return_value=iter([b"P001,2023-01-01T00:00:00Z,heart_rate,75\n"])
-        )
-        mock_data_response.__enter__ = Mock(return_value=mock_data_response)
-        mock_data_response.__exit__ = Mock(return_value=None)
 
-        # Mock urlopen to return the responses in order
-        mocker.patch(
-            "urllib.request.urlopen",
-            side_effect=[mock_export_response, mock_data_response],
-        )
+        # Mock the shared connection to return the responses in order
+        mock_conn = Mock()
+        mock_conn.getresponse.side_effect = [mock_export_response, mock_data_response]
+        mocker.patch("cli.main._get_connection", return_value=mock_conn)
 
         # Call process_data
         process_data("demo", None)
@@ -76,78 +83,182 @@ class TestProcessData:
     def test_process_data_with_output_file(self, tmp_path, mocker):
         # Mock the export API response
         mock_export_response = Mock()
+        mock_export_response.status = 200
         mock_export_response.read.return_value = (
             b'{"data": {"download_ids": ["test-id"]}}'
         )
-        mock_export_response.__enter__ = Mock(return_value=mock_export_response)
-        mock_export_response.__exit__ = Mock(return_value=None)
 
         # Mock the data API response
-        mock_data_response = Mock()
-        mock_data_response.readline.return_value = (
+        mock_data_response = FakeResponse(
             b"patient_id,event_time,event_type,value\n"
+            b"P001,2023-01-01T00:00:00Z,heart_rate,75\n"
         )
-        mock_data_response.__iter__ = Mock(
-            return_value=iter([b"P001,2023-01-01T00:00:00Z,heart_rate,75\n"])
+
+        # Mock the shared connection
+        mock_conn = Mock()
+        mock_conn.getresponse.side_effect = [mock_export_response, mock_data_response]
+        mocker.patch("cli.main._get_connection", return_value=mock_conn)
+
+        # Call process_data with a real output path; the file is opened in
+        # "w" or "wb" mode depending on the serializer, so assert on the
+        # written content rather than the open() call
+        output_file = tmp_path / "test_output.json"
+        process_data("demo", str(output_file))
+
+        # Check the written file
+        output = json.loads(output_file.read_text())
+        assert output["patients"]["P001"]["heart_rate"] == 1
+        assert output["totals"]["heart_rate"] == 1
+
+    def test_process_data_process_pool(self, capsys, mocker):
+        # 16 downloads reaches PROCESS_POOL_THRESHOLD and exercises the
+        # ProcessPoolExecutor branch: forked workers fetch with their own
+        # connections and their counts merge back in the parent
+        download_ids = [f"dl-{i:02d}" for i in range(16)]
+        mock_export_response = Mock()
+        mock_export_response.status = 200
+        mock_export_response.read.return_value = json.dumps(
+            {"data": {"download_ids": download_ids}}
+        ).encode()
+
+        data_responses = [
+            FakeResponse(
+                b"patient_id,event_time,event_type,value\n"
+                b"P001,2023-01-01T00:00:00Z,heart_rate,75\n"
+            )
+            for _ in download_ids
+        ]
+
+        mock_conn = Mock()
+        mock_conn.getresponse.side_effect = [mock_export_response, *data_responses]
+        mocker.patch("cli.main._get_connection", return_value=mock_conn)
+
+        # Call process_data
+        process_data("demo", None)
+
+        # One row per download, merged across all workers
+        output = json.loads(capsys.readouterr().out)
+        assert output["patients"]["P001"]["heart_rate"] == 16
+        assert output["totals"]["heart_rate"] == 16
+
+    def test_process_data_no_downloads(self, capsys, mocker):
+        # An export with no downloads yields empty patients/totals
+        mock_export_response = Mock()
+        mock_export_response.status = 200
+        mock_export_response.read.return_value = b'{"data": {"download_ids": []}}'
+
+        mock_conn = Mock()
+        mock_conn.getresponse.return_value = mock_export_response
+        mocker.patch("cli.main._get_connection", return_value=mock_conn)
+
+        # Call process_data
+        process_data("demo", None)
+
+        # Check the output
+        output = json.loads(capsys.readouterr().out)
+        assert output == {"patients": {}, "totals": {}}
+
+    def test_process_data_parse_error(self, mocker):
+        # A failure on the parse side must propagate out of process_data
+        # instead of deadlocking the fetch pool; four downloads overfill
+        # the bounded body queue, so producers are still blocked putting
+        # when the consumer raises
+        download_ids = [f"dl-{i}" for i in range(4)]
+        mock_export_response = Mock()
+        mock_export_response.status = 200
+        mock_export_response.read.return_value = json.dumps(
+            {"data": {"download_ids": download_ids}}
+        ).encode()
+
+        data_responses = [
+            FakeResponse(
+                b"patient_id,event_time,event_type,value\n"
+                b"P001,2023-01-01T00:00:00Z,heart_rate,75\n"
+            )
+            for _ in download_ids
+        ]
+
+        mock_conn = Mock()
+        mock_conn.getresponse.side_effect = [mock_export_response, *data_responses]
+        mocker.patch("cli.main._get_connection", return_value=mock_conn)
+        mocker.patch("cli.main._count_body", side_effect=ValueError("bad body"))
+
+        with pytest.raises(ValueError):
+            process_data("demo", None)
+
+    def test_process_data_stale_connection_retry(self, capsys, mocker):
+        # The server closed the idle keep-alive socket; _request should
+        # reconnect and retry the request once
+        mock_export_response = Mock()
+        mock_export_response.status = 200
+        mock_export_response.read.return_value = (
+            b'{"data": {"download_ids": ["test-id"]}}'
         )
-        mock_data_response.__enter__ = Mock(return_value=mock_data_response)
-        mock_data_response.__exit__ = Mock(return_value=None)
 
-        # Mock urlopen
-        mocker.patch(
-            "urllib.request.urlopen",
-            side_effect=[mock_export_response, mock_data_response],
+        mock_data_response = FakeResponse(
+            b"patient_id,event_time,event_type,value\n"
+            b"P001,2023-01-01T00:00:00Z,heart_rate,75\n"
         )
 
-        # Mock open for writing file
-        output_file = tmp_path / "test_output.json"
-        mock_open = mocker.patch("builtins.open", mocker.mock_open())
+        mock_conn = Mock()
+        mock_conn.getresponse.side_effect = [
+            http.client.RemoteDisconnected("Remote end closed connection"),
+            mock_export_response,
+            mock_data_response,
+        ]
+        mocker.patch("cli.main._get_connection", return_value=mock_conn)
 
         # Call process_data
-        process_data("demo", str(output_file))
+        process_data("demo", None)
 
-        # Check that open was called for writing
-        mock_open.assert_called_with(str(output_file), "w")
+        # The stale connection was closed and the request retried
+        mock_conn.close.assert_called_once()
+        output = json.loads(capsys.readouterr().out)
+        assert output["totals"]["heart_rate"] == 1
+
+    def test_process_data_http_error(self, mocker):
+        # A non-200 response must raise instead of being parsed as CSV
+        mock_error_response = Mock()
+        mock_error_response.status = 404
+        mock_error_response.read.return_value = b'{"detail": "Export not found"}'
+
+        mock_conn = Mock()
+        mock_conn.getresponse.return_value = mock_error_response
+        mocker.patch("cli.main._get_connection", return_value=mock_conn)
+
+        with pytest.raises(http.client.HTTPException):
+            process_data("demo", None)
 
     def test_process_data_malformed_row(self, capsys, mocker):
         # Mock the export API response
         mock_export_response = Mock()
+        mock_export_response.status = 200
         mock_export_response.read.return_value = (
             b'{"data": {"download_ids": ["test-id"]}}'
         )
-        mock_export_response.__enter__ = Mock(return_value=mock_export_response)
-        mock_export_response.__exit__ = Mock(return_value=None)
 
         # Mock the data API response with malformed row
-        mock_data_response = Mock()
-        mock_data_response.readline.return_value = (
+        mock_data_response = FakeResponse(
             b"patient_id,event_time,event_type,value\n"
+            b"P001,2023-01-01T00:00:00Z,heart_rate,75\n"
+            b"malformed,row\n"  # too few fields
+            b"P003,2023-01-01T00:00:00Z,heart_rate,75,extra\n"  # too many fields
+            b"P002,2023-01-01T00:00:00Z,spo2,98\n"
         )
-        mock_data_response.__iter__ = Mock(
-            return_value=iter(
-                [
-                    b"P001,2023-01-01T00:00:00Z,heart_rate,75\n",
-                    b"malformed,row\n",  # malformed
-                    b"P002,2023-01-01T00:00:00Z,spo2,98\n",
-                ]
-            )
-        )
-        mock_data_response.__enter__ = Mock(return_value=mock_data_response)
-        mock_data_response.__exit__ = Mock(return_value=None)
 
-        # Mock urlopen
-        mocker.patch(
-            "urllib.request.urlopen",
-            side_effect=[mock_export_response, mock_data_response],
-        )
+        # Mock the shared connection
+        mock_conn = Mock()
+        mock_conn.getresponse.side_effect = [mock_export_response, mock_data_response]
+        mocker.patch("cli.main._get_connection", return_value=mock_conn)
 
         # Call process_data
         process_data("demo", None)
 
-        # Check the output (should skip malformed row)
+        # Check the output (should skip both malformed rows)
         captured = capsys.readouterr()
         output = json.loads(captured.out)
         assert output["patients"]["P001"]["heart_rate"] == 1
         assert output["patients"]["P002"]["spo2"] == 1
+        assert "P003" not in output["patients"]
         assert output["totals"]["heart_rate"] == 1
         assert output["totals"]["spo2"] == 1